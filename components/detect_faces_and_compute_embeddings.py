@@ -1,32 +1,44 @@
 import argparse
 from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import io
 import math
+import multiprocessing as mp
 import os
+import queue
 import sys
+import tarfile
 import time
 from pathlib import Path
-from PIL import Image
-from threading import Thread
+import numpy as np
 
+import av
 import cv2
 cv2.setNumThreads(0)
 
 # Suppress tensorflow warnings
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-import components.models.facenet as facenet
-import components.models.mtcnn as mtcnn
 from util import config
 from util.consts import (
     FILE_BBOXES,
+    FILE_CROPS,
     FILE_EMBEDS,
-    FILE_METADATA,
-    DIR_CROPS
+    FILE_METADATA
 )
-from util.utils import json_is_valid, save_json, format_hmmss
+from util.utils import save_json, format_hmmss
 
 MODELS_DIR = 'components/data'
 
+# Software decoding threads in the main process
+DECODE_THREADS = 4
+
+# Hardware decoders to try, in order of preference, when hwaccel is 'auto'
+HWACCEL_DEVICES = ['cuda', 'vaapi', 'videotoolbox', 'qsv', 'd3d11va']
+
+# Hardware decoders that could not be initialized, see open_video
+failed_hwaccel_devices = set()
+
 
 NAMED_COMPONENTS = [
     'face_detection',
@@ -75,15 +87,16 @@ def process_videos(video_paths, out_paths, init_run=False, force=False,
 
     # Don't reingest videos with existing outputs
     if not init_run and not force:
+        required = [FILE_METADATA]
+        if 'face_detection' not in disable:
+            required.append(FILE_BBOXES)
+        if 'face_embeddings' not in disable:
+            required.append(FILE_EMBEDS)
+        if 'face_crops' not in disable:
+            required.append(FILE_CROPS)
+
         for i in range(len(video_paths) - 1, -1, -1):
-            if (('face_detection' in disable
-                or json_is_valid(os.path.join(out_paths[i], FILE_BBOXES)))
-                and ('face_embeddings' in disable
-                    or json_is_valid(os.path.join(out_paths[i], FILE_EMBEDS)))
-                and json_is_valid(os.path.join(out_paths[i], FILE_METADATA))
-                and ('face_crops' in disable
-                    or os.path.isdir(os.path.join(out_paths[i], DIR_CROPS)))
-            ):
+            if has_outputs(out_paths[i], required):
                 video_paths.pop(i)
                 out_paths.pop(i)
 
@@ -93,8 +106,6 @@ def process_videos(video_paths, out_paths, init_run=False, force=False,
         sys.stdout.flush()
         return
 
-    face_embedder, face_detector = load_models(MODELS_DIR)
-
     print('Collecting metadata for {} videos'.format(len(video_names)))
     sys.stdout.flush()
     all_metadata = [
@@ -102,173 +113,585 @@ def process_videos(video_paths, out_paths, init_run=False, force=False,
         for i in range(len(video_names))
     ]
 
-    n_threads = os.cpu_count() if os.cpu_count() else 1
+    # Skip videos that could not be opened or have no usable frame rate
+    for i in range(len(video_names) - 1, -1, -1):
+        if all_metadata[i] is None:
+            print('Could not read the metadata of video \'{}\'. '
+                  'Skipping.'.format(video_names[i]))
+            for l in (video_names, video_paths, out_paths, all_metadata):
+                l.pop(i)
+    sys.stdout.flush()
+    if not video_names:
+        return
 
     total_sec = int(sum(math.floor(m['frames'] / m['fps'] / interval) for m in all_metadata))
 
-    done_sec = 0
-    start_time = time.time()
-    for vid_id in range(len(video_names)):
-        path = video_paths[vid_id]
-        meta = all_metadata[vid_id]
-
-        print('Processing video: {} ({:0.1f} % done, {} elapsed)'.format(
-            meta['name'], done_sec / total_sec * 100, 
-            format_hmmss(time.time() - start_time)))
-        sys.stdout.flush()
-        thread_bboxes = [[] for _ in range(n_threads)]
-        thread_crops = [[] for _ in range(n_threads)]
-        thread_embeddings = [[] for _ in range(n_threads)]
-
-        threads = [Thread(
-            target=thread_task,
-            args=(str(path), meta, interval, n_threads, i, thread_bboxes, thread_crops,
-                  thread_embeddings, face_embedder, face_detector)
-        ) for i in range(n_threads)]
-
-        for t in threads:
-            t.start()
-
-        for t in threads:
-            t.join()
-
-        all_bboxes = []
-        all_crops = []
-        all_embeddings = []
-        for i in range(n_threads):
-            all_bboxes += thread_bboxes[i]
-            all_crops += thread_crops[i]
-            all_embeddings += thread_embeddings[i]
-
-        target_sec = math.floor(meta['frames'] / meta['fps'] / interval)
-        if any(len(x) != target_sec for x in [all_bboxes, all_crops, all_embeddings]):
-            # Error decoding video
-            print('\nThere was an error decoding video \'{}\'. Skipping.'.format(meta['name']))
+    # Frames are decoded sequentially here and fanned out in batches to worker
+    # processes, which run detection and embedding. A writer process collects
+    # the results in order and saves the outputs of each video.
+    ctx = mp.get_context('spawn')
+    n_workers = config.FACE_WORKERS or max(1, (os.cpu_count() or 1) // 4)
+    frame_queue = ctx.Queue(maxsize=2)
+    result_queue = ctx.Queue()
+
+    writer = ctx.Process(
+        target=writer_task,
+        args=(result_queue, all_metadata, [str(p) for p in out_paths], interval)
+    )
+    workers = []
+    try:
+        writer.start()
+        for cpus in get_worker_cpus(n_workers):
+            n_threads = (len(cpus) if cpus
+                         else max(1, (os.cpu_count() or 1) // n_workers))
+            w = ctx.Process(
+                target=worker_task,
+                args=(frame_queue, result_queue, MODELS_DIR, cpus, n_threads))
+            # Spawned processes inherit the environment when started, before
+            # they import numpy or tensorflow
+            with thread_limit_env(n_threads):
+                w.start()
+            workers.append(w)
+
+        def put_frames(item):
+            # Blocks while the workers are busy, so check they are still up
+            while True:
+                try:
+                    frame_queue.put(item, timeout=QUEUE_TIMEOUT)
+                    return
+                except queue.Full:
+                    check_processes(workers, writer)
+
+        done_sec = 0
+        start_time = time.time()
+        for vid_id in range(len(video_names)):
+            path = video_paths[vid_id]
+            meta = all_metadata[vid_id]
+
+            print('Processing video: {} ({:0.1f} % done, {} elapsed)'.format(
+                meta['name'], done_sec / max(total_sec, 1) * 100,
+                format_hmmss(time.time() - start_time)))
             sys.stdout.flush()
-            continue
-
-        print('Saving metadata for {}'.format(meta['name']))
-        sys.stdout.flush()
-        out_path = out_paths[vid_id]
-        metadata_outpath = out_path/FILE_METADATA
-        save_json(meta, str(metadata_outpath))
-
-        print('Saving bboxes for {}'.format(meta['name']))
-        sys.stdout.flush()
-        bbox_outpath = out_path/FILE_BBOXES
-        handle_face_bboxes_results(all_bboxes, meta['fps'] * interval, str(bbox_outpath))
-
-        print('Saving embeddings for {}'.format(meta['name']))
-        sys.stdout.flush()
-        embed_outpath = out_path/FILE_EMBEDS
-        handle_face_embeddings_results(all_embeddings, str(embed_outpath))
-
-        print('Saving crops for {}'.format(meta['name']))
-        sys.stdout.flush()
-        crops_outpath = out_path/DIR_CROPS
-        handle_face_crops_results(all_crops, str(crops_outpath))
 
-        done_sec += target_sec
+            check_processes(workers, writer)
+            n_batches = decode_video(str(path), meta, interval, vid_id,
+                                     put_frames)
+            # Tell the writer how many batches make up this video
+            put_frames((vid_id, n_batches, None))
+
+            done_sec += math.floor(meta['frames'] / meta['fps'] / interval)
+
+        for _ in workers:
+            put_frames(None)
+        for w in workers:
+            w.join()
+
+        result_queue.put(None)
+        writer.join()
+        if writer.exitcode != 0:
+            raise RuntimeError('The face output writer process exited with '
+                               'code {}'.format(writer.exitcode))
+    finally:
+        # Don't leave the children blocked on their queues if this raised
+        # (they are not daemons, so the interpreter would wait on them)
+        stop_processes(workers + [writer])
+        frame_queue.cancel_join_thread()
 
     print('Processed {} videos in {}'.format(
         len(video_names), format_hmmss(time.time() - start_time)))
     sys.stdout.flush()
 
-    face_embedder.close()
-    face_detector.close()
 
+# Seconds to wait on a full frame queue before checking on the processes
+QUEUE_TIMEOUT = 10
+
+
+def check_processes(workers, writer):
+    """Aborts the run if the writer or all of the workers have died."""
+    # Exit codes before the survivors are terminated below
+    writer_exitcode = writer.exitcode
+    worker_exitcodes = [w.exitcode for w in workers]
+    if writer_exitcode is None and None in worker_exitcodes:
+        return
 
-def load_models(models_dir):
-    face_embedder = facenet.FaceNetEmbed(os.path.join(models_dir, 'facenet'))
+    stop_processes(workers + [writer])
+    if writer_exitcode is not None:
+        raise RuntimeError('The face output writer process exited with code '
+                           '{}'.format(writer_exitcode))
+    raise RuntimeError('All face worker processes have exited (exit codes '
+                       '{})'.format(worker_exitcodes))
+
+
+def stop_processes(processes):
+    for p in processes:
+        if p.is_alive():
+            p.terminate()
+    for p in processes:
+        if p.pid is not None:
+            p.join()
+
+
+def has_outputs(out_dir, fnames):
+    """Checks that all of fnames exist and are non-empty in out_dir.
+
+    Only stats the directory, rather than parsing the outputs, since this runs
+    over every video in the batch. save_video_results writes the metadata
+    last, so a partially saved video is still picked up again.
+    """
+    sizes = {}
+    try:
+        with os.scandir(out_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    sizes[entry.name] = entry.stat().st_size
+    except FileNotFoundError:
+        return False
+    return all(sizes.get(f, 0) > 0 for f in fnames)
+
+
+def load_models(models_dir, n_threads=None):
+    # Imported here so that only the worker processes load tensorflow
+    import components.models.facenet as facenet
+    import components.models.mtcnn as mtcnn
+
+    if config.FACE_EMBEDDER == 'onnx':
+        from components.models.facenet_onnx import FaceNetEmbedONNX
+        face_embedder = FaceNetEmbedONNX(
+            os.path.join(models_dir, 'facenet', config.ONNX_MODEL),
+            config.ONNX_PROVIDERS, n_threads)
+    else:
+        face_embedder = facenet.FaceNetEmbed(os.path.join(models_dir, 'facenet'))
     face_detector = mtcnn.MTCNN(os.path.join(models_dir, 'align'))
     return face_embedder, face_detector
 
 
 def get_video_metadata(video_name: str, video_path: Path):
-    video = cv2.VideoCapture(str(video_path))
-    return {
-        'name': video_name,
-        'fps': video.get(cv2.CAP_PROP_FPS),
-        'frames': int(video.get(cv2.CAP_PROP_FRAME_COUNT)),
-        'width': int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
-        'height': int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    }
+    """
+    Returns None if the video cannot be opened, or its frame rate or frame
+    count cannot be determined.
+    """
+    # Only reads the container header, nothing is decoded
+    try:
+        container = av.open(str(video_path))
+    except av.error.FFmpegError:
+        return None
+    with container:
+        stream = container.streams.video[0]
+        rate = get_frame_rate(stream)
+        if not rate:
+            return None
+
+        # Not every container stores the frame count (e.g. MKV/WebM and raw
+        # streams), estimate it from the stream's or container's duration
+        frames = stream.frames
+        if not frames and stream.duration:
+            frames = int(stream.duration * stream.time_base * rate)
+        if not frames and container.duration:
+            frames = int(container.duration / av.time_base * rate)
+        if not frames:
+            return None
+
+        return {
+            'name': video_name,
+            'fps': float(rate),
+            'frames': frames,
+            'width': stream.codec_context.width,
+            'height': stream.codec_context.height
+        }
+
+
+def get_frame_rate(stream):
+    # Broken and variable frame rate videos may have no average rate
+    return stream.average_rate or stream.guessed_rate
+
+
+def open_video(in_path: str, hwaccel=config.HWACCEL):
+    """
+    Opens a video for decoding with PyAV, using a hardware decoder if one is
+    configured and can be initialized, and software decoding otherwise.
+
+    FFmpeg lists the device types it was built with, not the hardware that is
+    present, so with 'auto' each candidate is tried in turn. Devices that fail
+    to initialize are not tried again for later videos.
+
+    """
+
+    devices = []
+    if hwaccel:
+        from av.codec.hwaccel import HWAccel, hwdevices_available
+        if hwaccel == 'auto':
+            available = hwdevices_available()
+            devices = [d for d in HWACCEL_DEVICES if d in available]
+        else:
+            devices = [hwaccel]
+
+    container = None
+    failed = []
+    for device in devices:
+        if device in failed_hwaccel_devices:
+            continue
+        try:
+            container = av.open(in_path, hwaccel=HWAccel(
+                device_type=device, allow_software_fallback=True))
+            break
+        except av.error.FFmpegError:
+            failed.append(device)
+    if container is None:
+        container = av.open(in_path)
+    # Only blame the devices once the video itself is known to open
+    failed_hwaccel_devices.update(failed)
+
+    stream = container.streams.video[0]
+    # Enable FFmpeg's frame and slice threading, with a few threads since the
+    # CPUs are shared with the face workers
+    stream.thread_type = 'AUTO'
+    stream.codec_context.thread_count = DECODE_THREADS
+    return container
+
+
+def decode_frames(container, frame_nums, downscale=1):
+    """
+    Yields the RGB frames at the given (sorted) frame numbers, as pairs of the
+    full resolution frame and the frame downscaled by the given factor (the
+    same array when downscale is 1).
+
+    Seeks to the first frame (unless it is at the start of the video) and then
+    decodes sequentially, converting only the requested frames. Stops early if
+    the video ends or is corrupt.
+
+    """
+
+    if not frame_nums:
+        return
+
+    stream = container.streams.video[0]
+    rate = get_frame_rate(stream)
+    time_base = stream.time_base
+    start_pts = stream.start_time or 0
+
+    targets = iter(frame_nums)
+    target = next(targets)
+    seeked = target > 0
+    if seeked:
+        container.seek(start_pts + int(target / rate / time_base),
+                       stream=stream)
+
+    frames = container.decode(stream)
+    while target is not None:
+        frame = next(frames, None)
+        if frame is None:
+            return
+        if frame.pts is None:
+            continue
+        frame_num = round((frame.pts - start_pts) * time_base * rate)
+        if seeked:
+            seeked = False
+            if frame_num > target:
+                # The seek overshot the target (e.g. on MPEG-TS), decode from
+                # the start instead
+                container.seek(0)
+                frames = container.decode(stream)
+                continue
+        if frame_num < target:
+            continue
+
+        img = frame.to_ndarray(format='rgb24')
+        if downscale > 1:
+            # swscale converts and resizes in a single pass
+            small_img = frame.reformat(
+                width=frame.width // downscale,
+                height=frame.height // downscale,
+                format='rgb24').to_ndarray()
+        else:
+            small_img = img
+        while target is not None and target <= frame_num:
+            yield img, small_img
+            target = next(targets, None)
 
 
 BATCH_SIZE = 16
-def thread_task(in_path, metadata, interval, n_threads, thread_id,
-                thread_bboxes, thread_crops, thread_embeddings, face_embedder,
-                face_detector):
+def decode_video(in_path, metadata, interval, vid_id, put_frames):
+    """
+    Decodes the sampled frames of a video and queues them with put_frames in
+    batches of (vid_id, batch_idx, frames), where frames are pairs of the full
+    resolution frame and the frame downscaled for face detection.
 
-    video = cv2.VideoCapture(in_path)
+    Returns:
+        the number of batches queued.
 
-    if not video.isOpened():
+    """
+
+    try:
+        container = open_video(in_path)
+    except av.error.FFmpegError:
         print('Error opening video file.', in_path)
         sys.stdout.flush()
-        return
+        return 0
 
     n_sec = math.floor(metadata['frames'] / metadata['fps'] / interval)
-    chunk_size_sec = math.floor(n_sec / n_threads)
-    start_sec = chunk_size_sec * thread_id
-    if thread_id == n_threads - 1:
-        chunk_size_sec += n_sec % n_threads
-    end_sec = start_sec + chunk_size_sec
+    frame_nums = [math.ceil(i * metadata['fps'] * interval)
+                  for i in range(n_sec)]
+    frames_iter = decode_frames(container, frame_nums, config.DETECT_DOWNSCALE)
+
+    n_batches = 0
+    while True:
+        try:
+            frames = [frame for _, frame in zip(range(BATCH_SIZE), frames_iter)]
+        except av.error.FFmpegError:
+            # Corrupt video, the frame count check will catch this
+            break
+        if not frames:
+            break
+
+        put_frames((vid_id, n_batches, frames))
+        n_batches += 1
+
+    container.close()
+    return n_batches
+
+
+def get_worker_cpus(n_workers):
+    """Splits the available CPUs into disjoint sets, one per worker."""
+    if not hasattr(os, 'sched_getaffinity'):
+        return [None] * n_workers
+
+    cpus = sorted(os.sched_getaffinity(0))
+    if n_workers > len(cpus):
+        return [None] * n_workers
+    return [set(cpus[i::n_workers]) for i in range(n_workers)]
+
+
+@contextlib.contextmanager
+def thread_limit_env(n_threads):
+    """
+    Sizes the math library and tensorflow thread pools of processes started
+    within the context to n_threads. By default each worker would start a
+    thread per CPU in the machine, oversubscribing it many times over.
+    """
+    limits = {
+        'OMP_NUM_THREADS': str(n_threads),
+        'OPENBLAS_NUM_THREADS': str(n_threads),
+        'MKL_NUM_THREADS': str(n_threads),
+        'TF_NUM_INTRAOP_THREADS': str(n_threads),
+        'TF_NUM_INTEROP_THREADS': '1',
+    }
+    saved = {k: os.environ.get(k) for k in limits}
+    os.environ.update(limits)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+
+def worker_task(frame_queue, result_queue, models_dir, cpus=None, n_threads=1):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+
+    face_embedder, face_detector = load_models(models_dir, n_threads)
+
+    while True:
+        item = frame_queue.get()
+        if item is None:
+            break
+
+        vid_id, batch_idx, frames = item
+        if frames is None:
+            # End of video marker, pass it on to the writer
+            result_queue.put(item)
+            continue
+
+        try:
+            results = process_frames(frames, face_embedder, face_detector)
+        except Exception as e:
+            # Only this video is lost, the writer skips it
+            results = FailedBatch(repr(e))
+        result_queue.put((vid_id, batch_idx, results))
+
+    face_embedder.close()
+    face_detector.close()
 
-    for sec in range(start_sec, end_sec, BATCH_SIZE):
-        frames = []
 
-        for i in range(sec, min(sec + BATCH_SIZE, end_sec)):
-            frame_num = math.ceil(i * metadata['fps'] * interval)
-            video.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
-            success, frame = video.read()
-            if not success:
-                video.release()
-                return
+class FailedBatch(object):
+    """Stands in for the results of a batch that could not be processed."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def process_frames(frames, face_embedder, face_detector):
+    """
+    Detects faces in a batch of frames, computes their embeddings and crops.
+
+    Args:
+        frames: pairs of the full resolution frame, used for cropping, and the
+                downscaled frame, used for detection.
+
+    Returns:
+        a tuple of the per frame bboxes, embeddings and crops.
+
+    """
+
+    frames, detect_frames = zip(*frames)
+
+    # Bboxes are relative to the frame size, so they apply to both resolutions
+    detected_faces = face_detector.face_detect(list(detect_frames))
+    dilated_bboxes = [dilate_bboxes(bboxes_to_array(x))
+                      for x in detected_faces]
+
+    # Cropped images to compute embeddings on, and to be saved
+    embed_crops, crops = zip(*[
+        crop_bboxes_dual(f, bb, save_expand=0.1)
+        for f, bb in zip(frames, dilated_bboxes)
+    ])
+
+    # Embed the faces of every frame in the batch in one forward pass
+    flat_crops = [c for frame_crops in embed_crops for c in frame_crops]
+    flat_embeddings = face_embedder.embed(flat_crops) if flat_crops else []
+    embeddings = []
+    offset = 0
+    for frame_crops in embed_crops:
+        embeddings.append(flat_embeddings[offset:offset + len(frame_crops)])
+        offset += len(frame_crops)
+
+    return detected_faces, embeddings, list(crops)
+
+
+def writer_task(result_queue, all_metadata, out_paths, interval):
+    batches = {}  # {vid_id: {batch_idx: results}}
+    n_batches = {}  # {vid_id: number of batches}, once fully decoded
+
+    while True:
+        item = result_queue.get()
+        if item is None:
+            break
+
+        vid_id, batch_idx, results = item
+        if results is None:
+            n_batches[vid_id] = batch_idx
+        else:
+            batches.setdefault(vid_id, {})[batch_idx] = results
+
+        if (vid_id in n_batches
+                and len(batches.get(vid_id, {})) == n_batches[vid_id]):
+            vid_batches = batches.pop(vid_id, {})
+            del n_batches[vid_id]
+            vid_batches = [vid_batches[i] for i in range(len(vid_batches))]
+
+            failed = [b for b in vid_batches if isinstance(b, FailedBatch)]
+            if failed:
+                print('\nThere was an error processing video \'{}\' ({}). '
+                      'Skipping.'.format(all_metadata[vid_id]['name'],
+                                         failed[0].error))
+                sys.stdout.flush()
+                continue
+
+            try:
+                save_video_results(all_metadata[vid_id],
+                                   Path(out_paths[vid_id]), interval,
+                                   vid_batches)
+            except Exception as e:
+                # Keep the writer up for the remaining videos
+                print('\nThere was an error saving video \'{}\' ({!r}). '
+                      'Skipping.'.format(all_metadata[vid_id]['name'], e))
+                sys.stdout.flush()
+
+    # Videos whose batches were lost, e.g. to a crashed worker
+    for vid_id in sorted(set(batches) | set(n_batches)):
+        print('\nThere was an error processing video \'{}\'. Skipping.'.format(
+            all_metadata[vid_id]['name']))
+        sys.stdout.flush()
+
 
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frames.append(frame)
+def save_video_results(meta, out_path: Path, interval, batch_results):
+    all_bboxes = []
+    all_crops = []
+    all_embeddings = []
+    for bboxes, embeddings, crops in batch_results:
+        all_bboxes += bboxes
+        all_embeddings += embeddings
+        all_crops += crops
 
-        detected_faces = face_detector.face_detect(frames)
-        dilated_bboxes = [dilate_bboxes(x) if x else [] for x in detected_faces]
+    target_sec = math.floor(meta['frames'] / meta['fps'] / interval)
+    if any(len(x) != target_sec for x in [all_bboxes, all_crops, all_embeddings]):
+        # Error decoding video
+        print('\nThere was an error decoding video \'{}\'. Skipping.'.format(meta['name']))
+        sys.stdout.flush()
+        return
 
-        # Cropped images to compute embeddings on
-        crops = [[crop_bbox(f, bb) for bb in x] if x else []
-                 for f, x in zip(frames, dilated_bboxes)]
-        embeddings = [face_embedder.embed(c) if c else [] for c in crops]
+    print('Saving bboxes for {}'.format(meta['name']))
+    sys.stdout.flush()
+    bbox_outpath = out_path/FILE_BBOXES
+    handle_face_bboxes_results(all_bboxes, meta['fps'] * interval, str(bbox_outpath))
 
-        # Cropped images being saved
-        crops = [[crop_bbox(f, bb, expand=0.1, square=True) for bb in x] if x else []
-                 for f, x in zip(frames, dilated_bboxes)]
+    print('Saving embeddings for {}'.format(meta['name']))
+    sys.stdout.flush()
+    embed_outpath = out_path/FILE_EMBEDS
+    handle_face_embeddings_results(all_embeddings, str(embed_outpath))
 
-        thread_bboxes[thread_id].extend(detected_faces)
-        thread_embeddings[thread_id].extend(embeddings)
-        thread_crops[thread_id].extend(crops)
+    print('Saving crops for {}'.format(meta['name']))
+    sys.stdout.flush()
+    crops_outpath = out_path/FILE_CROPS
+    handle_face_crops_results(all_crops, str(crops_outpath))
 
-    video.release()
+    # Written last, see has_outputs
+    print('Saving metadata for {}'.format(meta['name']))
+    sys.stdout.flush()
+    metadata_outpath = out_path/FILE_METADATA
+    save_json(meta, str(metadata_outpath))
+
+
+BBOX_KEYS = ['x1', 'y1', 'x2', 'y2']
+def bboxes_to_array(detected_faces):
+    """Converts a frame's bbox dicts to an (N, 4) array of x1, y1, x2, y2."""
+    return np.array([[face[k] for k in BBOX_KEYS] for face in detected_faces],
+                    dtype=np.float32).reshape(-1, 4)
 
 
 DILATE_AMOUNT = 1.05
-def dilate_bboxes(detected_faces):
-    return [{
-        'x1': bbox['x1'] * (2 - DILATE_AMOUNT),
-        'x2': bbox['x2'] * DILATE_AMOUNT,
-        'y1': bbox['y1'] * (2 - DILATE_AMOUNT),
-        'y2': bbox['y2'] * DILATE_AMOUNT
-    } for bbox in detected_faces]
-
-
-def crop_bbox(img, bbox, expand=0.0, square=False):
-    y1 = max(bbox['y1'] - expand, 0)
-    y2 = min(bbox['y2'] + expand, 1)
-    x1 = max(bbox['x1'] - expand, 0)
-    x2 = min(bbox['x2'] + expand, 1)
-    h, w = img.shape[:2]
-    cropped = img[int(y1 * h):int(y2 * h), int(x1 * w):int(x2 * w), :]
-
-    if not square:
-        return cropped
-
-    # Crop largest square
+DILATE_SCALE = np.array([2 - DILATE_AMOUNT, 2 - DILATE_AMOUNT,
+                         DILATE_AMOUNT, DILATE_AMOUNT], dtype=np.float32)
+def dilate_bboxes(bboxes):
+    return bboxes * DILATE_SCALE
+
+
+def bbox_pixel_coords(bboxes, img_shape, expand=0.0):
+    """Expands, clips and scales (N, 4) relative bboxes to pixel coordinates."""
+    h, w = img_shape[:2]
+    expanded = np.clip(bboxes + np.array([-expand, -expand, expand, expand],
+                                         dtype=np.float32), 0, 1)
+    return (expanded * np.array([w, h, w, h], dtype=np.float32)).astype(np.int32)
+
+
+def crop_bboxes_dual(img, bboxes, save_expand=0.0):
+    """
+    Crops each bbox twice in one pass: tightly (for computing embeddings) and
+    expanded by save_expand then squared (for saving).
+
+    Returns:
+        the embedding crops, which are views into img, and the save crops,
+        which are contiguous copies ready to be encoded.
+
+    """
+
+    coords = bbox_pixel_coords(bboxes, img.shape)
+    save_coords = bbox_pixel_coords(bboxes, img.shape, save_expand)
+
+    embed_crops = []
+    save_crops = []
+    for (x1, y1, x2, y2), (sx1, sy1, sx2, sy2) in zip(coords, save_coords):
+        embed_crops.append(img[y1:y2, x1:x2, :])
+        save_crops.append(np.ascontiguousarray(
+            crop_square(img[sy1:sy2, sx1:sx2, :])))
+
+    return embed_crops, save_crops
+
+
+def crop_square(cropped):
+    """Crops the largest centered square."""
     if cropped.shape[0] > cropped.shape[1]:
         target_height = cropped.shape[1]
         diff = target_height // 2
@@ -299,8 +722,9 @@ def handle_face_bboxes_results(detected_faces, stride, outpath: str):
 def handle_face_embeddings_results(face_embeddings, outpath):
     result = []  # [(<face_id>, <embedding>), ...]
     for embeddings in face_embeddings:
+        # Embeddings are float32 arrays, which save_json serializes directly
         faces_in_frame = [
-            (face_id, [float(x) for x in embed])
+            (face_id, embed)
             for face_id, embed in enumerate(embeddings, len(result))
         ]
 
@@ -309,10 +733,10 @@ def handle_face_embeddings_results(face_embeddings, outpath):
     save_json(result, outpath)
 
 
-def handle_face_crops_results(face_crops, out_dirpath):
+def handle_face_crops_results(face_crops, outpath):
     # Results are too large to transmit
     results = get_face_crops_results(face_crops)
-    save_face_crops(results, out_dirpath)
+    save_face_crops(results, outpath)
 
 
 def get_face_crops_results(face_crops):
@@ -327,14 +751,40 @@ def get_face_crops_results(face_crops):
     return result
 
 
-def save_face_crops(face_crops, out_dirpath: str):
-    if not os.path.isdir(out_dirpath):
-        os.makedirs(out_dirpath)
-
-    def save_img(img, fp):
-        Image.fromarray(img).save(fp, optimize=True)
-
-    with ThreadPoolExecutor() as executor:
-        for face_id, img in face_crops:
-            img_filepath = os.path.join(out_dirpath, str(face_id) + '.png')
-            executor.submit(save_img, img, img_filepath)
+CROP_JPEG_QUALITY = 90
+def save_face_crops(face_crops, outpath: str):
+    """
+    Saves the face crops as '<face_id>.jpg' entries of a single uncompressed
+    tar file, rather than creating one file per face.
+
+    """
+
+    def encode_img(img):
+        # Bboxes clipped to the frame's edge can leave nothing to encode
+        if img.size == 0:
+            return None
+        # OpenCV releases the GIL while encoding, unlike PIL
+        try:
+            ok, buf = cv2.imencode(
+                '.jpg', cv2.cvtColor(img, cv2.COLOR_RGB2BGR),
+                [cv2.IMWRITE_JPEG_QUALITY, CROP_JPEG_QUALITY])
+        except cv2.error:
+            return None
+        return buf.tobytes() if ok else None
+
+    # Write to a temporary path so that partial outputs are never picked up
+    tmp_outpath = outpath + '.tmp'
+    mtime = time.time()
+    with ThreadPoolExecutor(os.cpu_count()) as executor, \
+            tarfile.open(tmp_outpath, 'w') as tar:
+        encoded = executor.map(encode_img, (img for _, img in face_crops))
+        for (face_id, _), data in zip(face_crops, encoded):
+            if data is None:
+                # Only this face is left out of the tar
+                continue
+            info = tarfile.TarInfo(name=str(face_id) + '.jpg')
+            info.size = len(data)
+            info.mtime = mtime
+            tar.addfile(info, io.BytesIO(data))
+
+    os.replace(tmp_outpath, outpath)
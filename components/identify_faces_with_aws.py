@@ -12,7 +12,7 @@ Example
     out_path: output_dir
 
     where 'output_dir' contains video output subdirectories (which in turn
-    contain their own 'crops' directories)
+    contain their own 'crops.tar' files)
 
     outputs
 
@@ -28,21 +28,38 @@ tuples.
 """
 
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import math
 from multiprocessing import Pool
 import os
 import sys
+import tarfile
 from pathlib import Path
 import time
 
 import boto3
+from botocore.config import Config
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, fall back to plain Python
+    def njit(f):
+        return f
 
 from util import config
-from util.consts import FILE_IDENTITIES, DIR_CROPS
-from components.montage_face_images import create_montage_bytes
+from util.consts import FILE_IDENTITIES, FILE_CROPS
+from components.montage_face_images import (create_montage_bytes,
+                                             estimate_montage_bytes)
 from util.utils import get_base_name, load_json, save_json, format_hmmss
 
+# Rekognition's limit on image size
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Rekognition client shared by the threads of a worker process
+worker_client = None
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -69,10 +86,10 @@ def main(in_path, out_path, force=False):
     # Prune videos that should not be run
     msg = []
     for i in range(len(video_names) - 1, -1, -1):
-        crops_path = in_path/video_names[i]/DIR_CROPS
-        if not crops_path.is_dir():
+        crops_path = in_path/video_names[i]/FILE_CROPS
+        if not crops_path.is_file():
             msg.append("Skipping face identification for video '{}': no '{}' "
-                       "directory found.".format(video_names[i], DIR_CROPS))
+                       "file found.".format(video_names[i], FILE_CROPS))
             video_names.pop(i)
             out_paths.pop(i)
             continue
@@ -98,9 +115,10 @@ def main(in_path, out_path, force=False):
 
     start_time = time.time()
     print('Identifying faces in {} videos'.format(len(video_names)))
-    with Pool(num_workers) as workers:
+    with Pool(num_workers, initializer=init_worker,
+              initargs=(num_threads_per_worker,)) as workers:
         for video_name, output_dir in zip(video_names, out_paths):
-            crops_path = in_path/video_name/DIR_CROPS
+            crops_path = in_path/video_name/FILE_CROPS
             identities_outpath = output_dir/FILE_IDENTITIES
             workers.apply_async(
                 process_video,
@@ -113,56 +131,61 @@ def main(in_path, out_path, force=False):
         format_hmmss(time.time() - start_time)))
 
 
+def init_worker(max_threads):
+    global worker_client
+    worker_client = load_client(max_threads)
+
+
 def process_video(crops_path, identities_outpath, max_threads=60):
-    assert os.path.isdir(crops_path)
+    assert os.path.isfile(crops_path)
 
-    img_files = [img for img in sorted(os.listdir(crops_path),
-                 key=lambda x: int(get_base_name(x)))]
+    client = worker_client if worker_client else load_client(max_threads)
+
+    with tarfile.open(crops_path) as tar:
+        members = sorted(tar.getmembers(),
+                         key=lambda m: int(get_base_name(m.name)))
 
     video_labels = []
     n_rows = config.MONTAGE_HEIGHT
     n_cols = config.MONTAGE_WIDTH
     with ThreadPoolExecutor(max_threads) as executor:
         futures = []
-        for i in range(0, len(img_files), n_cols * n_rows):
-            img_span = img_files[i:i + n_cols * n_rows]
+        for i in range(0, len(members), n_cols * n_rows):
+            member_span = members[i:i + n_cols * n_rows]
             futures.append(executor.submit(
-                submit_images_for_labeling, crops_path, img_span
+                submit_images_for_labeling, client, crops_path, member_span
             ))
 
-    for future in futures:
-        if future.done() and not future.cancelled():
+        for future in as_completed(futures):
             video_labels.extend(future.result())
 
+    video_labels.sort(key=lambda x: x[0])
     save_json(video_labels, identities_outpath)
 
 
-def submit_images_for_labeling(crops_path, img_files):
+def read_crops(crops_path, members):
+    """Reads the encoded images of the given members of a crops tar file."""
+    data = []
+    with open(crops_path, 'rb') as f:
+        for member in members:
+            f.seek(member.offset_data)
+            data.append(f.read(member.size))
+    return data
+
+
+def submit_images_for_labeling(client, crops_path, members):
     try:
-        client = load_client()
-        img_filepaths = [os.path.join(crops_path, f) for f in img_files]
-        montage_bytes, meta = create_montage_bytes(img_filepaths)
-        if len(montage_bytes) >= 5 * 1024 * 1024:
-            img_filepaths_1 = img_filepaths[:len(img_filepaths)//2]
-            img_filepaths_2 = img_filepaths[len(img_filepaths)//2:]
-            montage_bytes_1, meta_1 = create_montage_bytes(img_filepaths_1)
-            montage_bytes_2, meta_2 = create_montage_bytes(img_filepaths_2)
-            img_ids_1 = [int(get_base_name(x)) for x in img_files[:len(img_files)//2]]
-            img_ids_2 = [int(get_base_name(x)) for x in img_files[len(img_files)//2:]]
-            res_1 = search_aws(montage_bytes_1, client)
-            res_2 = search_aws(montage_bytes_2, client)
-
-            labels_1 = process_labeling_results(meta_1['cols'], meta_1['block_dim'],
-                                                img_ids_1, res_1)
-            labels_2 = process_labeling_results(meta_2['cols'], meta_2['block_dim'],
-                                                img_ids_2, res_2)
-            return labels_1 + labels_2
-
-        img_ids = [int(get_base_name(x)) for x in img_files]
-
-        res = search_aws(montage_bytes, client)
-        return process_labeling_results(meta['cols'], meta['block_dim'],
-                                        img_ids, res)
+        img_ids = [int(get_base_name(m.name)) for m in members]
+        imgs = read_crops(crops_path, members)
+
+        # Split up front into as many montages as the size limit requires
+        n_splits = math.ceil(estimate_montage_bytes(len(imgs)) / MAX_IMAGE_BYTES)
+        split_size = math.ceil(len(imgs) / max(n_splits, 1))
+        labels = []
+        for i in range(0, len(imgs), split_size):
+            labels += label_montage(client, imgs[i:i + split_size],
+                                    img_ids[i:i + split_size])
+        return labels
 
     except AssertionError as e:
         print(e)
@@ -175,22 +198,77 @@ def submit_images_for_labeling(crops_path, img_files):
         raise
 
 
+def label_montage(client, imgs, img_ids):
+    montage_bytes, meta = create_montage_bytes(imgs, img_ids)
+    if len(montage_bytes) >= MAX_IMAGE_BYTES and len(imgs) > 1:
+        # The size estimate was off, which should be rare
+        half = len(imgs) // 2
+        return (label_montage(client, imgs[:half], img_ids[:half])
+                + label_montage(client, imgs[half:], img_ids[half:]))
+
+    res = search_aws(montage_bytes, client)
+    return process_labeling_results(meta['cols'], meta['block_dim'],
+                                    img_ids, res)
+
 
 def search_aws(img_data, client):
     # Supported image formats: JPEG, PNG, GIF, BMP.
     # Image dimensions must be at least 50 x 50.
     # Image file size must be less than 5MB.
-    assert len(img_data) <= 5 * 1024 * 1024, 'File too large: {}'.format(len(img_data))
-    for i in range(10):
-        try:
-            resp = client.recognize_celebrities(Image={'Bytes': img_data})
-            return resp
-        except Exception as e:
-            delay = 2 ** i
-            print('Error (retry in {}s): {}'.format(delay, e))
-            sys.stdout.flush()
-            time.sleep(delay)
-    raise Exception('Too many timeouts: {}'.format(e))
+    assert len(img_data) <= MAX_IMAGE_BYTES, 'File too large: {}'.format(len(img_data))
+    # Throttling and transient errors are retried by the client (see
+    # load_client)
+    return client.recognize_celebrities(Image={'Bytes': img_data})
+
+
+def bounding_boxes_to_array(bounding_boxes):
+    """Converts AWS BoundingBox dicts to an (N, 4) array of x0, y0, x1, y1."""
+    boxes = np.zeros((len(bounding_boxes), 4), dtype=np.float64)
+    for i, bbox in enumerate(bounding_boxes):
+        boxes[i, 0] = bbox['Left']
+        boxes[i, 1] = bbox['Top']
+        boxes[i, 2] = bbox['Left'] + bbox['Width']
+        boxes[i, 3] = bbox['Top'] + bbox['Height']
+    return boxes
+
+
+@njit
+def map_boxes_to_grid(boxes, width, height, block_size, half_block_size,
+                      max_residual, n_cols, n_imgs):
+    """
+    Reverse maps face boxes in a montage to the grid cells they belong to.
+
+    A box is valid if its center is within max_residual of the center of a
+    cell holding an image.
+
+    Returns:
+        the grid x and y of each box, the L1 distance of each box's center to
+        the center of its cell, and whether each box is valid.
+
+    """
+
+    n = boxes.shape[0]
+    grid_xs = np.zeros(n, dtype=np.int64)
+    grid_ys = np.zeros(n, dtype=np.int64)
+    l1_dists = np.zeros(n, dtype=np.float64)
+    valid = np.zeros(n, dtype=np.bool_)
+    for i in range(n):
+        center_x = (boxes[i, 0] + boxes[i, 2]) / 2 * width
+        center_y = (boxes[i, 1] + boxes[i, 3]) / 2 * height
+        residual_x = abs(center_x % block_size - half_block_size)
+        residual_y = abs(center_y % block_size - half_block_size)
+
+        if residual_x < max_residual and residual_y < max_residual:
+            grid_x = math.floor(center_x / block_size)
+            grid_y = math.floor(center_y / block_size)
+            idx = grid_y * n_cols + grid_x
+            if idx >= 0 and idx < n_imgs:
+                grid_xs[i] = grid_x
+                grid_ys[i] = grid_y
+                l1_dists[i] = residual_x + residual_y
+                valid[i] = True
+
+    return grid_xs, grid_ys, l1_dists, valid
 
 
 def process_labeling_results(
@@ -201,14 +279,15 @@ def process_labeling_results(
     width = n_cols * block_size
     height = math.ceil(len(img_ids) / n_cols) * block_size
 
-    labels = {}
-    for face in aws_response['CelebrityFaces']:
-        x0 = face['Face']['BoundingBox']['Left']
-        y0 = face['Face']['BoundingBox']['Top']
-        x1 = x0 + face['Face']['BoundingBox']['Width']
-        y1 = y0 + face['Face']['BoundingBox']['Height']
+    celebrity_faces = aws_response['CelebrityFaces']
+    unrecognized_faces = aws_response['UnrecognizedFaces']
+    celebrity_boxes = bounding_boxes_to_array(
+        [face['Face']['BoundingBox'] for face in celebrity_faces])
+    unrecognized_boxes = bounding_boxes_to_array(
+        [face['BoundingBox'] for face in unrecognized_faces])
 
-        if img_draw:
+    if img_draw:
+        for face, (x0, y0, x1, y1) in zip(celebrity_faces, celebrity_boxes):
             img_draw.rectangle(
                 (x0 * width, y0 * height, x1 * width, y1 * height),
                 outline='red')
@@ -216,56 +295,43 @@ def process_labeling_results(
                 face['Name'].encode('ascii', 'ignore'), face['MatchConfidence'])
             img_draw.text((x0 * width, y0 * height), text, fill='red')
 
-        # Reverse map the index
-        center_x = (x0 + x1) / 2 * width
-        center_y = (y0 + y1) / 2 * height
-        residual_x = abs(center_x % block_size - half_block_size)
-        residual_y = abs(center_y % block_size - half_block_size)
-
-        # Center must be in middle third of the image
-        if (residual_x < sixth_block_size and residual_y < sixth_block_size):
-            grid_x = math.floor(center_x / block_size)
-            grid_y = math.floor(center_y / block_size)
-            idx = grid_y * n_cols + grid_x
-            if idx >= 0 and idx < len(img_ids):
-                face_id = img_ids[idx]
-                l1_dist = residual_x + residual_y
-                face_label = (face['Name'], face['MatchConfidence'], l1_dist,
-                              grid_x, grid_y)
-                if face_id in labels:
-                    if labels[face_id][2] > l1_dist:
-                        labels[face_id] = face_label
-                else:
-                    labels[face_id] = face_label
-
-    for face in aws_response['UnrecognizedFaces']:
-        x0 = face['BoundingBox']['Left']
-        y0 = face['BoundingBox']['Top']
-        x1 = x0 + face['BoundingBox']['Width']
-        y1 = y0 + face['BoundingBox']['Height']
-
-        if img_draw:
+        for x0, y0, x1, y1 in unrecognized_boxes:
             img_draw.rectangle(
                 (x0 * width, y0 * height, x1 * width, y1 * height),
                 outline='blue')
 
-        # Reverse map the index
-        center_x = (x0 + x1) / 2 * width
-        center_y = (y0 + y1) / 2 * height
-        residual_x = abs(center_x % block_size - half_block_size)
-        residual_y = abs(center_y % block_size - half_block_size)
+    # Center must be in middle third of the image
+    grid_xs, grid_ys, l1_dists, valid = map_boxes_to_grid(
+        celebrity_boxes, width, height, block_size, half_block_size,
+        sixth_block_size, n_cols, len(img_ids))
 
-        # Center must be in middle of the image
-        if (residual_x < half_block_size and residual_y < half_block_size):
-            grid_x = math.floor(center_x / block_size)
-            grid_y = math.floor(center_y / block_size)
-            idx = grid_y * n_cols + grid_x
-            if idx >= 0 and idx < len(img_ids):
-                face_id = img_ids[idx]
-                l1_dist = residual_x + residual_y
-                if face_id in labels:
-                    if labels[face_id][2] > l1_dist:
-                        del labels[face_id]
+    labels = {}
+    for i, face in enumerate(celebrity_faces):
+        if not valid[i]:
+            continue
+        grid_x, grid_y = int(grid_xs[i]), int(grid_ys[i])
+        face_id = img_ids[grid_y * n_cols + grid_x]
+        l1_dist = float(l1_dists[i])
+        face_label = (face['Name'], face['MatchConfidence'], l1_dist,
+                      grid_x, grid_y)
+        if face_id in labels:
+            if labels[face_id][2] > l1_dist:
+                labels[face_id] = face_label
+        else:
+            labels[face_id] = face_label
+
+    # Center must be in middle of the image
+    grid_xs, grid_ys, l1_dists, valid = map_boxes_to_grid(
+        unrecognized_boxes, width, height, block_size, half_block_size,
+        half_block_size, n_cols, len(img_ids))
+
+    for i in range(len(unrecognized_faces)):
+        if not valid[i]:
+            continue
+        face_id = img_ids[int(grid_ys[i]) * n_cols + int(grid_xs[i])]
+        if face_id in labels:
+            if labels[face_id][2] > l1_dists[i]:
+                del labels[face_id]
 
     if img_draw:
         for label_meta in labels.values():
@@ -277,11 +343,16 @@ def process_labeling_results(
     return [(k, v[0], v[1]) for k, v in labels.items()]
 
 
-def load_client():
+def load_client(max_pool_connections=10):
+    # Adaptive mode retries with backoff and also rate limits requests on the
+    # client side once throttling is detected. The connection pool is sized to
+    # the number of threads sharing the client.
+    client_config = Config(retries={'max_attempts': 10, 'mode': 'adaptive'},
+                           max_pool_connections=max_pool_connections)
     session = boto3.session.Session()
     return session.client('rekognition', aws_access_key_id=config.AWS_ACCESS_KEY_ID,
                           aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
-                          region_name=config.AWS_REGION)
+                          region_name=config.AWS_REGION, config=client_config)
 
 
 if __name__ == '__main__':
@@ -37,10 +37,11 @@ class FaceNetEmbed(object):
         print('Loaded face-embedder model')
 
     def embed(self, imgs):
-        modified = [
-            facenet.prewhiten(cv2.resize(img, (self.in_size, self.in_size)))
-            for img in imgs
-        ]
+        modified = np.empty((len(imgs), self.in_size, self.in_size, 3),
+                            dtype=np.float32)
+        for i, img in enumerate(imgs):
+            modified[i] = facenet.prewhiten(
+                cv2.resize(img, (self.in_size, self.in_size)))
 
         embs = self.session.run(
             self.embeddings,
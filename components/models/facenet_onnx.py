@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+
+def prewhiten(x):
+    # Same normalization as facenet.prewhiten, without importing tensorflow
+    mean = np.mean(x)
+    std = np.std(x)
+    std_adj = np.maximum(std, 1.0 / np.sqrt(x.size))
+    return np.multiply(np.subtract(x, mean), 1 / std_adj)
+
+
+class FaceNetEmbedONNX(object):
+    """FaceNet embedder running an exported ONNX graph with ONNX Runtime."""
+
+    def __init__(self, model_path, providers=None, num_threads=None):
+        self.in_size = 160
+
+        print('Loading face-embedder model...')
+        available = ort.get_available_providers()
+        if providers:
+            providers = [p for p in providers if p in available]
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            model_path, sess_options=options, providers=providers or available)
+        self.input_name = self.session.get_inputs()[0].name
+
+        # Hide one-time initialization costs (e.g. CUDA) behind a warmup run
+        self.embed([np.zeros((self.in_size, self.in_size, 3), dtype=np.uint8)])
+        print('Loaded face-embedder model')
+
+    def embed(self, imgs):
+        modified = np.empty((len(imgs), self.in_size, self.in_size, 3),
+                            dtype=np.float32)
+        for i, img in enumerate(imgs):
+            modified[i] = prewhiten(
+                cv2.resize(img, (self.in_size, self.in_size)))
+
+        return self.session.run(None, {self.input_name: modified})[0]
+
+    def close(self):
+        pass
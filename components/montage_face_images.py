@@ -8,14 +8,12 @@ be sent to face identification services (like AWS).
 
 """
 
-import cv2
-import io
+import math
 
+import cv2
 import numpy as np
-from PIL import Image
 
 from util.config import MONTAGE_WIDTH, MONTAGE_HEIGHT
-from util.utils import get_base_name
 
 IMG_SIZE = 200
 BLOCK_SIZE = 250
@@ -26,19 +24,31 @@ assert IMG_SIZE + 2 * PADDING == BLOCK_SIZE, \
 
 BLANK_IMAGE = np.zeros((BLOCK_SIZE, BLOCK_SIZE, 3), dtype=np.uint8)
 
+JPEG_QUALITY = 90
+# Upper estimate of the JPEG encoded size of a montage, per pixel
+JPEG_BYTES_PER_PIXEL = 0.75
+
 
-def create_montage_bytes(img_filepaths, nrows=MONTAGE_HEIGHT,
+def create_montage_bytes(imgs, ids, nrows=MONTAGE_HEIGHT,
                          ncols=MONTAGE_WIDTH):
-    assert len(img_filepaths) <= nrows * ncols
-    try:
-        ids = [int(get_base_name(p)) for p in img_filepaths]
-    except ValueError:
-        raise Exception('Face crop filenames must be integer IDs')
-    
+    """
+    Tiles encoded face crop images (e.g. JPEG bytes) into a JPEG montage.
+
+    Args:
+        imgs: the encoded images.
+        ids: the face ID of each image.
+
+    """
+
+    assert len(imgs) <= nrows * ncols
+    assert len(imgs) == len(ids)
+
     stacked_rows = []
-    for i in range(0, len(img_filepaths), ncols):
-        row_imgs = [convert_image(np.asarray(Image.open(path)))
-                for path in img_filepaths[i:i + ncols]]
+    for i in range(0, len(imgs), ncols):
+        # Decoded as BGR and encoded from BGR, so no color conversion needed
+        row_imgs = [convert_image(cv2.imdecode(np.frombuffer(data, np.uint8),
+                                               cv2.IMREAD_COLOR))
+                for data in imgs[i:i + ncols]]
         row_imgs += [BLANK_IMAGE] * (ncols - len(row_imgs))
         stacked_rows.append(np.hstack(row_imgs))
 
@@ -50,9 +60,15 @@ def create_montage_bytes(img_filepaths, nrows=MONTAGE_HEIGHT,
         'content': ids
     }
 
-    with io.BytesIO() as f:
-        Image.fromarray(stacked_img).save(f, 'png')
-        return f.getvalue(), stacked_img_meta
+    _, buf = cv2.imencode('.jpg', stacked_img,
+                          [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buf.tobytes(), stacked_img_meta
+
+
+def estimate_montage_bytes(n_imgs, ncols=MONTAGE_WIDTH):
+    """Estimates the encoded size of a montage, without building it."""
+    nrows = math.ceil(n_imgs / ncols)
+    return nrows * ncols * BLOCK_SIZE ** 2 * JPEG_BYTES_PER_PIXEL
 
 
 def convert_image(im):
@@ -30,7 +30,7 @@ FILE_IDENTITIES_PROP = 'identities_propogated.json'
 FILE_CAPTIONS = 'captions.srt'
 FILE_CAPTIONS_ORIG = 'captions_orig.srt'
 FILE_ALIGNMENT_STATS = 'alignment_stats.json'
-DIR_CROPS = 'crops'
+FILE_CROPS = 'crops.tar'
 
 ALL_OUTPUTS = [
     FILE_BBOXES,
@@ -42,7 +42,7 @@ ALL_OUTPUTS = [
     FILE_CAPTIONS,
     FILE_CAPTIONS_ORIG,
     FILE_ALIGNMENT_STATS,
-    DIR_CROPS
+    FILE_CROPS
 ]
 
 WORKING_DIR = '.catch_up_tmp'
@@ -265,7 +265,10 @@ def upload_pipeline_output_to_cloud(args):
 
     if os.path.exists(identifier):
         # does not upload crops
-        cmd = ['gsutil', 'cp', '-n', os.path.join(identifier, '*'),
+        out_files = [os.path.join(identifier, f) for f in os.listdir(identifier)
+                     if f != FILE_CROPS]
+        out_files = [f for f in out_files if os.path.isfile(f)]
+        cmd = ['gsutil', 'cp', '-n', *out_files,
                os.path.join(gcs_output_path, identifier)]
         subprocess.check_call(cmd)
 
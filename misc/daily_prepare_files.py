@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import errno
 import fcntl
@@ -13,6 +14,9 @@ import shutil
 import subprocess
 import time
 
+from google.cloud import storage
+from google.cloud.storage import transfer_manager
+
 
 GCS_OUTPUT_DIR = 'gs://tvnews-ingest/pipeline-outputs'
 GCS_SYNC_DIR = 'gs://tvnews-ingest/pipeline-sync'
@@ -25,6 +29,12 @@ LOCAL_OUTPUT_PATH = '/tmp/pipeline_outputs'
 
 PREFIXES = ['MSNBC', 'MSNBCW', 'CNN', 'CNNW', 'FOXNEWS', 'FOXNEWSW']
 
+# Pipeline outputs that the viewer does not need
+EXCLUDE_OUTPUTS = re.compile(r'embeddings\.json|black_frames\.json|alignment_stats\.json')
+
+# Cloud Storage client of each download process, set up by init_worker
+worker_client = None
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -129,7 +139,8 @@ def download_unprepared_outputs(year, local_out_path, gcs_output_path, num_proce
 
     sync_with_worker()
 
-    available_outputs = list_pipeline_outputs(year, gcs_output_path)
+    client = storage.Client()
+    available_outputs = list_pipeline_outputs(client, year, gcs_output_path)
 
     processed_outputs = list_processed_outputs()
 
@@ -142,7 +153,7 @@ def download_unprepared_outputs(year, local_out_path, gcs_output_path, num_proce
 
     orig_path = os.getcwd()
     os.chdir(local_out_path)
-    pool = Pool(num_processes)
+    pool = Pool(num_processes, initializer=init_worker)
     num_done = 0
     start_time = time.time()
     for _ in pool.imap_unordered(download_pipeline_output, [(i, gcs_output_path, local_out_path) for i in to_download]):
@@ -154,16 +165,36 @@ def download_unprepared_outputs(year, local_out_path, gcs_output_path, num_proce
     return to_download
 
 
+def init_worker():
+    # One client per process, rather than per download. Clients are not safe
+    # to share across a fork, so each worker creates its own.
+    global worker_client
+    worker_client = storage.Client()
+
+
 def download_pipeline_output(args):
     identifier, gcs_output_path, local_out_path = args
-    # subprocess.check_call(['gsutil', '-m', 'cp', '-nr', os.path.join(gcs_output_path, identifier), './'])
     local_out_dir = os.path.join(local_out_path, identifier)
     os.makedirs(local_out_dir, exist_ok=True)
-    subprocess.check_call([
-        'gsutil', '-m', 'rsync', '-x',
-        '"embeddings\\.json|black_frames\\.json|alignment_stats\\.json"',
-        '-r', os.path.join(gcs_output_path, identifier), local_out_dir
-    ])
+
+    bucket, path = get_bucket(worker_client or storage.Client(),
+                              gcs_output_path)
+    prefix = '{}/{}/'.format(path, identifier)
+    blob_names = [
+        blob.name[len(prefix):] for blob in bucket.list_blobs(prefix=prefix)
+        if not EXCLUDE_OUTPUTS.search(blob.name)
+    ]
+    # Threads rather than processes, since this already runs in a Pool worker
+    transfer_manager.download_many_to_path(
+        bucket, blob_names, destination_directory=local_out_dir,
+        blob_name_prefix=prefix, worker_type=transfer_manager.THREAD,
+        skip_if_exists=True, raise_exception=True)
+
+
+def get_bucket(client, gcs_path):
+    """Splits a gs:// path into its bucket and the path within the bucket."""
+    bucket_name, _, path = gcs_path[len('gs://'):].partition('/')
+    return client.bucket(bucket_name), path.rstrip('/')
 
 
 def list_processed_outputs():
@@ -174,19 +205,23 @@ def list_processed_outputs():
     return videos
 
 
-def list_pipeline_outputs(year, gcs_output_path):
-    videos = set()
-
-    for prefix in PREFIXES:
-        try:
-            output = subprocess.check_output(
-                ['gsutil', 'ls', '-d', '{}/{}_{}*'.format(gcs_output_path, prefix, year)]
-            ).decode()
+def list_pipeline_outputs(client, year, gcs_output_path):
+    bucket, path = get_bucket(client, gcs_output_path)
 
-            videos |= {parse_identifier(x) for x in output.split('\n') if x.strip()}
-        except subprocess.CalledProcessError as e:
+    def list_prefix(prefix):
+        blobs = bucket.list_blobs(prefix='{}/{}_{}'.format(path, prefix, year),
+                                  delimiter='/')
+        # The "directories" are only collected as the pages are consumed
+        for _ in blobs.pages:
             pass
+        return blobs.prefixes
+
+    videos = set()
+    with ThreadPoolExecutor(len(PREFIXES)) as executor:
+        for prefixes in executor.map(list_prefix, PREFIXES):
+            videos |= {parse_identifier(x) for x in prefixes}
 
+    print('Found {} pipeline outputs for {}'.format(len(videos), year))
     return videos
 
 
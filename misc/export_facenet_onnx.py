@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+File: export_facenet_onnx.py
+----------------------------
+Exports the FaceNet checkpoint in components/data to an ONNX graph, for use
+with `face_embedder: onnx` in the configuration file.
+
+Run from the root of the repository after unpacking the models:
+
+    python3 misc/export_facenet_onnx.py
+
+With `--quantize`, an int8 copy of the model (with dynamically quantized
+weights, for CPU inference) is also written next to it, e.g.
+`facenet.int8.onnx`.
+
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.append('.')
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import tensorflow as tf
+import tf2onnx
+
+from util import config
+
+MODEL_DIR = 'components/data/facenet'
+MODEL_DATA_DIR = os.path.join(MODEL_DIR, '20170512-110547')
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out-path',
+                        default=os.path.join(MODEL_DIR, config.ONNX_MODEL),
+                        help='path to write the ONNX model to')
+    parser.add_argument('--opset', type=int, default=13,
+                        help='ONNX opset to target')
+    parser.add_argument('-q', '--quantize', action='store_true',
+                        help='also write an int8 quantized copy of the model')
+    return parser.parse_args()
+
+
+def main(out_path, opset=13, quantize=False):
+    tf.compat.v1.disable_eager_execution()
+    sys.path.append(MODEL_DIR)
+    import facenet
+
+    meta_file, ckpt_file = facenet.get_model_filenames(MODEL_DATA_DIR)
+    with tf.Graph().as_default() as graph, \
+            tf.compat.v1.Session(graph=graph) as session:
+        # Bake in inference mode so the batch norm conditionals fold away
+        saver = tf.compat.v1.train.import_meta_graph(
+            os.path.join(MODEL_DATA_DIR, meta_file),
+            input_map={'phase_train:0': tf.constant(False)})
+        saver.restore(session, os.path.join(MODEL_DATA_DIR, ckpt_file))
+        frozen = tf.compat.v1.graph_util.convert_variables_to_constants(
+            session, graph.as_graph_def(), ['embeddings'])
+
+    tf2onnx.convert.from_graph_def(
+        frozen, input_names=['input:0'], output_names=['embeddings:0'],
+        opset=opset, output_path=out_path)
+    print('Saved ONNX model to {}'.format(out_path))
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        root, ext = os.path.splitext(out_path)
+        quantized_path = root + '.int8' + ext
+        quantize_dynamic(out_path, quantized_path, weight_type=QuantType.QInt8)
+        print('Saved quantized ONNX model to {}'.format(quantized_path))
+
+
+if __name__ == '__main__':
+    main(**vars(get_args()))
@@ -1,33 +1,97 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import functools
+import hashlib
+import itertools
 import os
+import random
+import re
 import sys
-import json
-from multiprocessing import Pool
-from SPARQLWrapper import SPARQLWrapper, JSON
+import threading
 
+import aiohttp
+import ijson
+import orjson
 
-PERSON_QUERY = """
+SPARQL_ENDPOINT = 'http://dbpedia.org/sparql'
+
+
+# Each query is built by concatenating its prefix and suffix around the one
+# variable part, which is cheaper than str.format
+PERSON_QUERY_PREFIX = """
 PREFIX dbo: <http://dbpedia.org/ontology/>
 PREFIX schema: <http://schema.org/>
-SELECT ?person WHERE {{?person foaf:name "{}"@en}}
+SELECT ?person WHERE {?person foaf:name \""""
+PERSON_QUERY_SUFFIX = """"@en}
+"""
+
+# Resolves many names at once, around a list of "name"@en literals
+BATCH_PERSON_QUERY_PREFIX = """
+SELECT ?name ?person WHERE {
+  VALUES ?name { """
+BATCH_PERSON_QUERY_SUFFIX = """ }
+  ?person foaf:name ?name
+}
 """
 
-DATA_QUERY = """
+DATA_QUERY_PREFIX = """
 SELECT ?property ?hasValue ?isValueOf
-WHERE {{
-  {{ <{url}> ?property ?hasValue }}
-}}
+WHERE {
+  { <"""
+DATA_QUERY_SUFFIX = """> ?property ?hasValue }
+}
 """
 
 LINK_TYPES = ('wikiPageWikiLink', 'wikiPageExternalLink')
 
+# Properties kept in the results, see keep_property
+ONTOLOGY_PREFIX = 'http://dbpedia.org/ontology/'
+PURL_PREFIX = 'http://purl.org/'
+DROP_PROPERTY_SUFFIXES = LINK_TYPES + ('abstract',)
+KEEP_PROPERTY_RE = re.compile('{}(?!.*(?:{})$)|{}'.format(
+    re.escape(ONTOLOGY_PREFIX),
+    '|'.join(re.escape(s) for s in DROP_PROPERTY_SUFFIXES),
+    re.escape(PURL_PREFIX)))
+
+# The requests are network bound, so many can be in flight at once
+MAX_CONCURRENT_QUERIES = 50
+
+# Number of names to resolve per query, and how many such queries to run
+# ahead of the data queries for the names they resolve
+BATCH_SIZE = 100
+MAX_RESOLVING_BATCHES = 4
+
+# Written to the output directory, see ResultWriter
+RESULTS_FILE = 'results.jsonl'
+INDEX_FILE = 'index.tsv'
+FAILED_FILE = 'failed.txt'
+WRITE_BUFFER_SIZE = 1 << 16
+
+# In seconds, including time spent waiting for a connection
+QUERY_TIMEOUT = 120
+
+# Attempts per query on transient errors (timeouts, 5xx and 429 responses)
+QUERY_TRIES = 5
+
+# Shared by all queries, so that connections to the endpoint are reused.
+# All set up by run_with_session.
+session = None
+query_semaphore = None
+
+# Directory of cached query responses, if any
+response_cache_dir = None
+
+# Properties of the URIs being fetched, see fetch_properties
+uri_properties = {}
+
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        'out_dir', type=str, help='Directory to write scraped results to')
+        'out_dir', type=str,
+        help='Directory to write scraped results (and their index) to')
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
@@ -39,54 +103,67 @@ def get_args():
     parser.add_argument(
         '-q', '--query', type=str,
         help='A specific query corresponding to a specific name')
+    parser.add_argument(
+        '-j', '--concurrency', dest='n', type=int,
+        default=MAX_CONCURRENT_QUERIES,
+        help='Maximum number of queries to run at once')
+    parser.add_argument(
+        '--cache-dir', type=str,
+        help='Directory to cache SPARQL responses in, across runs')
     return parser.parse_args()
 
 
 def load_names(fpath):
-    names = []
     with open(fpath) as f:
         for line in f:
             line = line.strip()
             if line:
-                names.append(line)
-    return names
+                yield line
 
 
+@functools.lru_cache(maxsize=1 << 16)
 def split_uri(uri):
-    idx = uri.rfind('/')
-    return uri[:idx], uri[idx + 1:]
+    prefix, _, resource = uri.rpartition('/')
+    return prefix, resource
+
+
+# Scores for resources that contain the name, lower is more plausible. An
+# exact match scores 0 and a resource with none of the keywords scores its
+# length.
+RESOURCE_KEYWORD_SCORES = (
+    ('television', 1), ('journalist', 1), ('news', 1), ('politic', 2))
+
+
+def score_resource(name_lower, resource_lower):
+    if name_lower == resource_lower:
+        return 0
+    for keyword, score in RESOURCE_KEYWORD_SCORES:
+        if keyword in resource_lower:
+            return score
+    return len(resource_lower)
 
 
 def select_uri(name, uris):
     """Use heuristics to guess which URI is the correct one"""
     if len(uris) == 1:
         return uris[0]
+    name_lower = name.lower()
     plausible_uris = []
     for u in uris:
-        prefix, resource = split_uri(u)
-        if name.lower() in resource.lower().replace('_', ' '):
-            if name.lower() == resource.lower().replace('_', ' '):
-                plausible_uris.append((0, u))
-            elif 'television' in resource.lower():
-                plausible_uris.append((1, u))
-            elif 'journalist' in resource.lower():
-                plausible_uris.append((1, u))
-            elif 'news' in resource.lower():
-                plausible_uris.append((1, u))
-            elif 'politic' in resource.lower():
-                plausible_uris.append((2, u))
-            else:
-                plausible_uris.append((len(resource), u))
+        resource_lower = split_uri(u)[1].lower().replace('_', ' ')
+        if name_lower in resource_lower:
+            plausible_uris.append(
+                (score_resource(name_lower, resource_lower), u))
     if len(plausible_uris) == 0:
-        plausible_uris.extend(uris)
-    plausible_uris.sort(key=lambda x: x[0])
-    return plausible_uris[0][1]
+        return uris[0]
+    return min(plausible_uris, key=lambda x: x[0])[1]
 
 
 def split_upper_join(s, delim=' '):
     return delim.join(t[0].upper() + t[1:] for t in s.split(delim))
 
 
+@functools.lru_cache(maxsize=4096)
 def to_name_case(name):
     name = split_upper_join(name)
     name = split_upper_join(name, "'")
@@ -95,26 +172,189 @@ def to_name_case(name):
     return name
 
 
-def query_dbpedia(name):
+async def run_with_session(coro, n=MAX_CONCURRENT_QUERIES, cache_dir=None):
+    global session, query_semaphore, response_cache_dir
+    query_semaphore = asyncio.Semaphore(n)
+    response_cache_dir = cache_dir
+    uri_properties.clear()
+    # Keep one open connection per concurrent query. Idle connections are
+    # kept alive for longer than the default, to outlast gaps between names.
+    connector = aiohttp.TCPConnector(
+        limit=n, limit_per_host=n, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=QUERY_TIMEOUT)
+    # The responses repeat long URI prefixes and compress well. aiohttp asks
+    # for them compressed by default (including brotli, when installed) and
+    # decompresses them as they are streamed.
+    async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout) as session:
+        return await coro
+
+
+async def sparql_query(query, keep=None):
+    """
+    Returns the result bindings of a query, or only those for which keep
+    returns True. Cached responses only hold the kept bindings, which is fine
+    since a query is always run with the same filter.
+    """
+    if response_cache_dir is None:
+        return await sparql_query_endpoint(query, keep)
+
+    # The queries are deterministic, so the response can be reused
+    cache_path = os.path.join(
+        response_cache_dir, hashlib.sha1(query.encode()).hexdigest() + '.json')
+    # The file I/O runs on the default thread pool, so that it does not block
+    # the event loop
+    loop = asyncio.get_running_loop()
+    bindings = await loop.run_in_executor(None, read_cache, cache_path)
+    if bindings is None:
+        bindings = await sparql_query_endpoint(query, keep)
+        await loop.run_in_executor(None, write_cache, cache_path, bindings)
+    return bindings
+
+
+def read_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_cache(cache_path, bindings):
+    # Identical queries may be cached at the same time on different threads
+    tmp_path = '{}.{}.tmp'.format(cache_path, threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(bindings))
+    os.replace(tmp_path, cache_path)
+
+
+def is_query_error(e):
+    """Whether e is an error from a single query, rather than a bug"""
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def is_transient(e):
+    if isinstance(e, aiohttp.ClientResponseError):
+        # Other client errors, e.g. a malformed query, will not go away
+        return e.status >= 500 or e.status == 429
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+async def sparql_query_endpoint(query, keep=None):
+    for i in range(QUERY_TRIES):
+        try:
+            return await sparql_query_endpoint_once(query, keep)
+        except Exception as e:
+            if i == QUERY_TRIES - 1 or not is_transient(e):
+                raise
+            print('  query failed ({!r}), retrying'.format(e),
+                  file=sys.stderr)
+        # Backoff with jitter, so failed queries are not retried in lockstep
+        await asyncio.sleep(2 ** i + random.random())
+
+
+async def sparql_query_endpoint_once(query, keep=None):
+    async with query_semaphore:
+        async with session.post(SPARQL_ENDPOINT, data={
+            'query': query, 'format': 'application/sparql-results+json'
+        }) as resp:
+            resp.raise_for_status()
+            # Parse the bindings as they stream in, rather than building the
+            # whole response, which can be megabytes for popular people
+            bindings = ijson.items(resp.content, 'results.bindings.item',
+                                   use_float=True)
+            return [b async for b in bindings if keep is None or keep(b)]
+
+
+def fetch_properties(uri):
+    """
+    Returns a future for the kept properties of uri. Names that resolve to
+    the same person (e.g. aliases) while its DATA_QUERY is in flight share
+    that query. Finished queries are not kept, since the responses can be
+    large; --cache-dir deduplicates those.
+    """
+    task = uri_properties.get(uri)
+    if task is None:
+        task = asyncio.ensure_future(
+            sparql_query(DATA_QUERY_PREFIX + uri + DATA_QUERY_SUFFIX,
+                         keep_property))
+        uri_properties[uri] = task
+        task.add_done_callback(lambda _: uri_properties.pop(uri, None))
+    return task
+
+
+def keep_property(result):
+    r_prop = result.get('property')
+    return (r_prop is not None and r_prop['type'] == 'uri'
+            and KEEP_PROPERTY_RE.match(r_prop['value']) is not None)
+
+
+def get_query_name(name):
     print('Querying: ' + name, file=sys.stderr)
     if name.islower():
         name_cased = to_name_case(name)
         print('  name cased: ' + name_cased, file=sys.stderr)
     else:
         name_cased = name
-    sparql = SPARQLWrapper("http://dbpedia.org/sparql")
-    sparql.setQuery(PERSON_QUERY.format(name_cased.replace('"', '')))
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
+    return name_cased
+
+
+async def resolve_name(name_cased):
+    results = await sparql_query(
+        PERSON_QUERY_PREFIX + name_cased.replace('"', '')
+        + PERSON_QUERY_SUFFIX)
 
     uris = []
-    for result in results["results"]["bindings"]:
+    for result in results:
         if 'person' in result:
             uri = result['person']['value']
             uris.append(uri)
-
+    return uris
+
+
+async def try_resolve_name(name_cased):
+    """Like resolve_name, but returns None if the query fails"""
+    try:
+        return await resolve_name(name_cased)
+    except Exception as e:
+        if not is_query_error(e):
+            raise
+        print('  failed to resolve {}: {!r}'.format(name_cased, e),
+              file=sys.stderr)
+        return None
+
+
+async def resolve_names_batch(names_cased):
+    """
+    Resolves the candidate URIs for many names with one query. If the query
+    is rejected, the names are resolved one by one instead, and those that
+    fail alone map to None.
+    """
+    values = ' '.join('"' + n.replace('"', '') + '"@en' for n in names_cased)
+    try:
+        results = await sparql_query(
+            BATCH_PERSON_QUERY_PREFIX + values + BATCH_PERSON_QUERY_SUFFIX)
+    except aiohttp.ClientResponseError as e:
+        # Still failing after retries, let resolve_batch record the names
+        if is_transient(e):
+            raise
+        # Some name broke the query, fall back to querying them one by one
+        uris = await asyncio.gather(
+            *[try_resolve_name(n) for n in names_cased])
+        return dict(zip(names_cased, uris))
+
+    name_to_uris = {n.replace('"', ''): [] for n in names_cased}
+    for result in results:
+        if 'person' in result and 'name' in result:
+            name_to_uris.setdefault(result['name']['value'], []).append(
+                result['person']['value'])
+    return {n: name_to_uris[n.replace('"', '')] for n in names_cased}
+
+
+async def fetch_data(name, name_cased, uris):
     if len(uris) > 0:
-        print('  found {} URIs:'.format(len(uris)), file=sys.stderr)
+        print('  found {} URIs for {}:'.format(len(uris), name),
+              file=sys.stderr)
 
         uris.sort(key=lambda x: len(x))
         for uri in uris:
@@ -122,71 +362,245 @@ def query_dbpedia(name):
         selected_uri = select_uri(name, uris)
 
         print('  using:', selected_uri, file=sys.stderr)
-        sparql.setQuery(DATA_QUERY.format(url=selected_uri))
-        sparql.setReturnFormat(JSON)
-        results = sparql.query().convert()
-        parsed_results = []
-        for result in results["results"]["bindings"]:
-            r_prop = result.get('property')
-            if not r_prop:
-                continue
-            if r_prop['type'] == 'uri':
-                r_prop_value = r_prop['value']
-                if r_prop_value.startswith('http://dbpedia.org/ontology/'):
-                    if r_prop_value.endswith(LINK_TYPES):
-                        pass
-                    elif r_prop_value.endswith('abstract'):
-                        pass
-                    else:
-                        parsed_results.append(result)
-                elif r_prop_value.startswith('http://purl.org/'):
-                    parsed_results.append(result)
+        parsed_results = await fetch_properties(selected_uri)
         return {
             'name': name_cased,
             'uri': selected_uri,
             'data': parsed_results,
             'other_uris': uris
         }
-    print('  no suitable URIs:'.format(len(uris), name_cased), file=sys.stderr)
+    print('  no suitable URIs for {}'.format(name), file=sys.stderr)
     return None
 
 
-def process_single_name(name, out_path):
-    if not os.path.exists(out_path):
-        result = query_dbpedia(name)
+async def query_dbpedia(name):
+    name_cased = get_query_name(name)
+    return await fetch_data(name, name_cased, await resolve_name(name_cased))
+
+
+class ResultWriter(object):
+    """
+    Appends results to a single JSON lines file in out_dir. The byte offsets
+    of the start and end of each name's result line are appended to a tab
+    separated index file, which is loaded at startup so that names with
+    results can be skipped.
+
+    Both files are buffered, so an interrupted run can leave a partial last
+    line in either. They are truncated back to their last complete line at
+    startup, and only index entries whose result line is complete are kept.
+    The index is then rewritten without the dropped entries, so that they
+    cannot point into results appended later.
+
+    Names with a result from before results were aggregated, as a
+    {name}.json file in out_dir, are skipped too.
+    """
+
+    def __init__(self, out_dir):
+        out_path = os.path.join(out_dir, RESULTS_FILE)
+        index_path = os.path.join(out_dir, INDEX_FILE)
+        out_size = truncate_to_last_line(out_path)
+        truncate_to_last_line(index_path)
+        self.index = self.load_index(index_path, out_size)
+        self.save_index(index_path, self.index)
+        self.legacy_names = self.list_legacy_results(out_dir)
+        self.out_file = open(out_path, 'ab', buffering=WRITE_BUFFER_SIZE)
+        self.index_file = open(index_path, 'a', buffering=WRITE_BUFFER_SIZE)
+
+    @staticmethod
+    def load_index(index_path, out_size):
+        index = {}  # {name: (start, end)}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    name, start, end = line.rstrip('\n').rsplit('\t', 2)
+                    # Drop entries whose result never fully made it to disk
+                    if int(end) <= out_size:
+                        index[name] = (int(start), int(end))
+        return index
+
+    @staticmethod
+    def save_index(index_path, index):
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+            for name, (start, end) in index.items():
+                f.write('{}\t{}\t{}\n'.format(name, start, end))
+        os.replace(tmp_path, index_path)
+
+    @staticmethod
+    def list_legacy_results(out_dir):
+        # One directory listing, rather than a stat per name
+        with os.scandir(out_dir) as it:
+            return {entry.name[:-len('.json')] for entry in it
+                    if entry.name.endswith('.json') and entry.is_file()}
+
+    def __contains__(self, name):
+        return name in self.index or name in self.legacy_names
+
+    def write(self, name, result):
+        start = self.out_file.tell()
+        self.out_file.write(orjson.dumps(result) + b'\n')
+        end = self.out_file.tell()
+        self.index_file.write('{}\t{}\t{}\n'.format(name, start, end))
+        self.index[name] = (start, end)
+
+    def close(self):
+        self.out_file.close()
+        self.index_file.close()
+
+
+def truncate_to_last_line(path):
+    """Cuts off a partial last line of a file. Returns the new size."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'r+b') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - WRITE_BUFFER_SIZE)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+    return end
+
+
+async def resolve_batch(names, failed_names):
+    names_cased = [get_query_name(n) for n in names]
+    try:
+        name_to_uris = await resolve_names_batch(names_cased)
+    except Exception as e:
+        if not is_query_error(e):
+            raise
+        print('  failed to resolve {} names: {!r}'.format(len(names), e),
+              file=sys.stderr)
+        failed_names.extend(names)
+        return [], [], {}
+
+    # Names that broke the query even on their own
+    resolved = [i for i, n in enumerate(names_cased)
+                if name_to_uris[n] is not None]
+    if len(resolved) < len(names):
+        failed_names.extend(names[i] for i in range(len(names))
+                            if name_to_uris[names_cased[i]] is None)
+        names = [names[i] for i in resolved]
+        names_cased = [names_cased[i] for i in resolved]
+    return names, names_cased, name_to_uris
+
+
+async def fetch_batch(names, names_cased, name_to_uris, writer,
+                      names_wo_results, failed_names):
+    async def process_single_name(name, name_cased):
+        try:
+            result = await fetch_data(name, name_cased,
+                                      list(name_to_uris[name_cased]))
+        except Exception as e:
+            # Permanent errors too, e.g. a URI that breaks the DATA_QUERY
+            if not is_query_error(e):
+                raise
+            print('  failed to fetch {}: {!r}'.format(name, e),
+                  file=sys.stderr)
+            failed_names.append(name)
+            return
         if result:
-            with open(out_path, 'w') as f:
-                json.dump(result, f)
-        return result is not None
-    return True
-
-
-def main(out_dir, name_file=None, name=None, query=None, n=4):
+            writer.write(name, result)
+        else:
+            names_wo_results.append(name)
+
+    await asyncio.gather(
+        *[process_single_name(*x) for x in zip(names, names_cased)])
+
+
+async def process_names(names, writer, names_wo_results, failed_names):
+    """
+    Resolves the names in batches, and fetches the data for a batch's names
+    as soon as it is resolved, while the next batches are being resolved.
+    Only a few batches are resolved ahead, so that the data queries are not
+    queued behind the resolve queries of every batch.
+
+    Names without a DBpedia entry are appended to names_wo_results, and those
+    whose queries still failed after retries to failed_names.
+    """
+    # names is only iterated once, so it can be a generator
+    names = (n for n in names if n not in writer)
+
+    resolving = set()
+    fetching = []
+
+    def start_fetch(resolved_batch):
+        fetching.append(asyncio.create_task(fetch_batch(
+            *resolved_batch, writer, names_wo_results, failed_names)))
+
+    while True:
+        batch = list(itertools.islice(names, BATCH_SIZE))
+        if not batch:
+            break
+        resolving.add(asyncio.create_task(
+            resolve_batch(batch, failed_names)))
+        if len(resolving) >= MAX_RESOLVING_BATCHES:
+            resolved, resolving = await asyncio.wait(
+                resolving, return_when=asyncio.FIRST_COMPLETED)
+            for task in resolved:
+                start_fetch(task.result())
+    for task in asyncio.as_completed(resolving):
+        start_fetch(await task)
+
+    await asyncio.gather(*fetching)
+
+
+def save_failed_names(failed_names, failed_path):
+    # The failed names can be retried later, with this file as the list
+    if failed_names:
+        with open(failed_path, 'w') as f:
+            for name in failed_names:
+                f.write(name + '\n')
+        print('{} names failed, see {}'.format(
+            len(failed_names), failed_path), file=sys.stderr)
+    elif os.path.exists(failed_path):
+        os.remove(failed_path)
+
+
+def main(out_dir, name_file=None, name=None, query=None,
+         n=MAX_CONCURRENT_QUERIES, cache_dir=None):
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    def get_out_path(name):
-        return os.path.join(out_dir, '{}.json'.format(name))
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    writer = ResultWriter(out_dir)
 
     if name_file:
         assert query is None, 'Specific queries are not allowed with a file'
         names = load_names(name_file)
-        with Pool(n) as p:
-            has_results = p.starmap(
-                process_single_name, [(n, get_out_path(n)) for n in names])
+        names_wo_results = []
+        failed_names = []
+        try:
+            asyncio.run(run_with_session(process_names(
+                names, writer, names_wo_results, failed_names), n, cache_dir))
+        finally:
+            writer.close()
+            # Also kept if the run is aborted partway through
+            save_failed_names(failed_names, os.path.join(out_dir, FAILED_FILE))
         print('Done!', file=sys.stderr)
 
-        names_wo_results = [a for a, b in zip(names, has_results) if not b]
         if names_wo_results:
             print('The following names are missing results:')
             for name in names_wo_results:
                 print(name)
     elif name:
-        result = query_dbpedia(query if query else name)
+        try:
+            result = asyncio.run(run_with_session(
+                query_dbpedia(query if query else name), n, cache_dir))
+            if result:
+                # Replaces any earlier result for the name in the index
+                writer.write(name, result)
+        finally:
+            writer.close()
         if result:
-            out_path = get_out_path(name)
-            with open(out_path, 'w') as f:
-                json.dump(result, f)
             print('Success!', file=sys.stderr)
         else:
             print('No entry found!... try again with a different query?',
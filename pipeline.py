@@ -44,9 +44,7 @@ Sample output directory after pipeline completion:
     │   ├── captions.srt
     │   ├── captions_orig.srt
     │   ├── commercials.json
-    │   └── crops
-    │       ├── 0.png
-    │       └── 1.png
+    │   └── crops.tar
     ├── video2
     │   └── ...
     └── ...
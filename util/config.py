@@ -18,6 +18,12 @@ CONFIG_KEYS = {
 
     # Face component
     'interval': 1, # seconds/sample
+    'hwaccel': 'auto', # hardware decoder: 'auto', a device type, or None
+    'face_workers': None, # detection/embedding processes, defaults to #cpus/4
+    'detect_downscale': 4, # factor to downscale frames by for face detection
+    'face_embedder': 'tensorflow', # or 'onnx' (see misc/export_facenet_onnx.py)
+    'onnx_model': 'facenet.onnx', # relative to the facenet model directory
+    'onnx_providers': ['CUDAExecutionProvider', 'CPUExecutionProvider'],
 
     # Face identification with AWS
     'montage_width': 10, # number of columns of images
@@ -11,9 +11,9 @@ FILE_BLACK_FRAMES = 'black_frames.json'
 FILE_CAPTIONS = 'captions.srt'
 FILE_CAPTIONS_ORIG = 'captions_orig.srt'
 FILE_COMMERCIALS = 'commercials.json'
+FILE_CROPS = 'crops.tar'
 FILE_EMBEDS = 'embeddings.json'
 FILE_GENDERS = 'genders.json'
 FILE_IDENTITIES = 'identities.json'
 FILE_IDENTITIES_PROP = 'identities_propogated.json'
 FILE_METADATA = 'metadata.json'
-DIR_CROPS = 'crops'
@@ -12,6 +12,8 @@ import os
 from pathlib import Path
 from typing import Callable, List
 
+import orjson
+
 
 def save_json(data, fname: str) -> None:
     """
@@ -23,7 +25,11 @@ def save_json(data, fname: str) -> None:
 
     """
 
-    json.dump(data, open(fname, 'w'))
+    # orjson is several times faster than json and serializes numpy arrays and
+    # scalars natively (float32 values are written in their shortest form)
+    with open(fname, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY
+                                          | orjson.OPT_NON_STR_KEYS))
 
 
 def load_json(fname: str):
@@ -38,7 +44,8 @@ def load_json(fname: str):
 
     """
 
-    return json.load(open(fname, 'r'))
+    with open(fname, 'rb') as f:
+        return orjson.loads(f.read())
 
 
 def get_base_name(path: str) -> str: